@@ -3,15 +3,18 @@ Script to fetch data about an NFT mint on the Solana network. Capabilities inclu
 - Fetching mint token list from a CandyMachine ID
 - Printing an ordered list of how many NFTs each wallet is holding
 - Printing a rarity assessment of the different traits from metadata
-- Outputting a CSV snapshotting token info and current holders
+- Outputting a CSV (or Parquet/Feather) snapshot of token info and current holders
 
 Originally based on https://github.com/GMnky/Python-Solana-NFT-Snapshot but significantly overhauled since
 """
 import asyncio
+import functools
 import logging
 import time
 from argparse import ArgumentParser
+from collections import Counter
 from typing import Callable
+from typing import Optional
 
 import aiohttp
 import tqdm
@@ -75,8 +78,7 @@ def main(
     # If required, bust cache. otherwise, load it
     token_cache.initialize(token_file_name.split(".")[0])
     if bust_cache:
-        # all_tokens is empty, so we can just overwrite the cache with it
-        token_cache.save(all_tokens)
+        token_cache.clear()
     else:
         all_tokens = token_cache.load()
 
@@ -135,66 +137,117 @@ def main(
 
 
 def populate_holders_details_async(all_tokens: dict) -> dict:
-    """Fetch data about which wallets own the NFTs specified by the given token IDs. Fetched data is cached at the end.
+    """Fetch data about which wallets own the NFTs specified by the given token IDs. Fetched data is cached after each
+    step.
 
     :param all_tokens: A dict of all the token data being operated upon
     :return: The all_tokens dict populated for each token
     """
+    return asyncio.run(fetch_holders_details_async(all_tokens))
+
+
+async def fetch_holders_details_async(all_tokens: dict) -> dict:
+    """Run each step of fetching holder data within the same event loop, so they can share one rate limit.
+
+    :param all_tokens: A dict of all the token data being operated upon
+    :return: The all_tokens dict populated for each token
+    """
+    # Limiters can't be shared across event loops, so this is as far as the RPC rate budget can be shared
+    rpc_limiter = AsyncLimiter(sh.MAX_REQUESTS_PER_SECOND, 1)
+
     start_time = time.time()
     logging.info("\nPopulating token account details...")
-    asyncio.run(
-        fetch_token_data_from_network_async(
-            sh.create_solana_client,
-            all_tokens,
-            "token_account",
-            sh.get_token_account_from_solana_async,
-        )
+    await fetch_token_data_from_network_async(
+        sh.create_solana_client,
+        all_tokens,
+        "token_account",
+        sh.get_token_account_from_solana_async,
+        rpc_limiter,
     )
-    token_cache.save(all_tokens)
     logging.info("--- %s seconds ---", (time.time() - start_time))
 
     start_time = time.time()
     logging.info("\nPopulating holders details...")
-    result = sh.get_holder_account_info_from_solana(all_tokens)
-    token_cache.save(all_tokens)
+    await fetch_batched_token_data_from_network_async(
+        sh.create_solana_client,
+        all_tokens,
+        "holder_address",
+        sh.get_holder_account_info_from_solana_async,
+        rpc_limiter,
+    )
     logging.info("--- %s seconds ---", (time.time() - start_time))
-    return result
+    return all_tokens
 
 
 def populate_account_details_async(all_tokens: dict) -> dict:
-    """Fetch metadata about the given token IDs, including attributes. Fetched data is cached at the end.
+    """Fetch metadata about the given token IDs, including attributes. Fetched data is cached after each step.
 
     :param all_tokens: A dict of all the token data being operated upon
     :return: The all_tokens dict populated for each token
     """
+    return asyncio.run(fetch_account_details_async(all_tokens))
+
+
+async def fetch_account_details_async(all_tokens: dict) -> dict:
+    """Fetch token metadata from Solana and Arweave within the same event loop, with one rate limit per endpoint. The
+    Arweave fetch for each token starts as soon as its Solana metadata is in, so the two steps overlap.
+
+    :param all_tokens: A dict of all the token data being operated upon
+    :return: The all_tokens dict populated for each token
+    """
+    rpc_limiter = AsyncLimiter(sh.MAX_REQUESTS_PER_SECOND, 1)
+    http_limiter = AsyncLimiter(hh.MAX_REQUESTS_PER_SECOND, 1)
+
+    # Tokens are handed to the Arweave fetch as soon as their metadata URI is known, rather than waiting for every
+    # Solana request to finish first. Tokens with cached metadata can go straight away
+    ready_tokens = asyncio.Queue()
+    for token in all_tokens.values():
+        if token.name is not None and token.image is None:
+            ready_tokens.put_nowait(token)
+
+    def on_metadata_done(token: Token) -> None:
+        if token.image is None:
+            ready_tokens.put_nowait(token)
+
     start_time = time.time()
-    logging.info("\nPopulating account details...")
-    asyncio.run(
+    logging.info("\nPopulating account and token metadata details...")
+    arweave_task = asyncio.create_task(
         fetch_token_data_from_network_async(
-            sh.create_solana_client,
+            hh.create_http_client,
             all_tokens,
-            "name",
-            sh.get_account_info_from_solana_async,
+            "image",
+            get_arweave_metadata,
+            http_limiter,
+            ready_tokens,
         )
     )
-    token_cache.save(all_tokens)
-    logging.info("--- %s seconds ---", (time.time() - start_time))
-
-    start_time = time.time()
-    logging.info("\nPopulating token metadata details...")
-    result = asyncio.run(
-        fetch_token_data_from_network_async(
-            hh.create_http_client, all_tokens, "image", get_arweave_metadata
+    try:
+        await fetch_batched_token_data_from_network_async(
+            sh.create_solana_client,
+            all_tokens,
+            "name",
+            functools.partial(
+                sh.get_metadata_account_info_from_solana_async, on_token_done=on_metadata_done
+            ),
+            rpc_limiter,
         )
-    )
-    token_cache.save(all_tokens)
+        logging.info("--- %s seconds (account details) ---", (time.time() - start_time))
+    finally:
+        # Tokens whose metadata couldn't be fetched are left out: fetching them with no URI would mark them as having
+        # no image or traits, and that would get cached rather than retried next run
+        ready_tokens.put_nowait(None)
+        await arweave_task
     logging.info("--- %s seconds ---", (time.time() - start_time))
-
-    return result
+    return all_tokens
 
 
 async def fetch_token_data_from_network_async(
-    create_client_fn: Callable, all_tokens: dict, key: str, get_data_fn: Callable
+    create_client_fn: Callable,
+    all_tokens: dict,
+    key: str,
+    get_data_fn: Callable,
+    limiter: AsyncLimiter,
+    ready_tokens: Optional[asyncio.Queue] = None,
 ) -> dict:
     """Method to abstract the async client and task management for data fetching. Creates a task for each token
 
@@ -202,20 +255,91 @@ async def fetch_token_data_from_network_async(
     :param all_tokens: A dict of all the token data being operated upon
     :param key: The key in token_data to save the fetched data to
     :param get_data_fn: The function to call in order to fetch the data
+    :param limiter: An AsyncLimiter for the endpoint being fetched from, shared by everything fetching from it
+    :param ready_tokens: Optional queue that tokens are put on once they're ready to be fetched, followed by None
+        when there are no more. If not given, every token missing data is fetched straight away
     :return: The all_tokens dict populated for each token
     """
-    limiter = AsyncLimiter(100, 1)
-    cache_task = asyncio.create_task(token_cache.periodic_cache_task(all_tokens))
+    # Only cache misses need fetching; if there aren't any, don't bother setting up a client at all
+    tokens = [token for token in all_tokens.values() if getattr(token, key) is None]
+    if not tokens:
+        return all_tokens
+
+    # Tokens are checkpointed to the cache as they finish, rather than rewriting everything each time
+    pending_tokens = {}
+    cache_task = asyncio.create_task(token_cache.periodic_cache_task(pending_tokens))
     async with create_client_fn() as client:
-        tasks = []
-        for token in all_tokens.keys():
-            if getattr(all_tokens[token], key) is None:
-                tasks.append(asyncio.create_task(get_data_fn(client, all_tokens[token], limiter)))
-        [await f for f in tqdm.tqdm(asyncio.as_completed(tasks), total=len(tasks))]
+        with tqdm.tqdm(total=len(tokens)) as progress_bar:
+
+            def on_task_done(task: asyncio.Task) -> None:
+                progress_bar.update()
+                if not task.cancelled() and task.exception() is None:
+                    pending_tokens[task.result().token] = task.result()
+
+            def create_task(token: Token) -> asyncio.Task:
+                task = asyncio.create_task(get_data_fn(client, token, limiter))
+                task.add_done_callback(on_task_done)
+                return task
+
+            if ready_tokens is None:
+                tasks = [create_task(token) for token in tokens]
+            else:
+                tokens = []
+                tasks = []
+                while (token := await ready_tokens.get()) is not None:
+                    tokens.append(token)
+                    tasks.append(create_task(token))
+                # Not every token missing data is necessarily handed over
+                progress_bar.total = len(tasks)
+                progress_bar.refresh()
+            # Gather the exceptions rather than raising them so one bad token doesn't sink the rest of the batch
+            results = await asyncio.gather(*tasks, return_exceptions=True)
     try:
         cache_task.cancel()
     except asyncio.CancelledError:
         pass
+    # Write out whatever finished since the last checkpoint
+    if pending_tokens:
+        token_cache.save(pending_tokens)
+
+    failures = 0
+    for token, result in zip(tokens, results):
+        if isinstance(result, BaseException):
+            failures += 1
+            logger.debug("Fetching %s failed for token %s: %r", key, token.token, result)
+    if failures:
+        logger.warning("Unable to fetch %s for %s tokens, rerun to retry them", key, failures)
+    return all_tokens
+
+
+async def fetch_batched_token_data_from_network_async(
+    create_client_fn: Callable,
+    all_tokens: dict,
+    key: str,
+    get_data_fn: Callable,
+    limiter: AsyncLimiter,
+) -> dict:
+    """Method to abstract the async client management for data that is fetched in batches. Unlike
+    fetch_token_data_from_network_async, get_data_fn is called once with all the tokens missing data and is in charge
+    of chunking
+
+    :param create_client_fn: Function that creates and returns the async network client used to fetch data
+    :param all_tokens: A dict of all the token data being operated upon
+    :param key: The key in token_data that get_data_fn populates
+    :param get_data_fn: The function to call in order to fetch the data
+    :param limiter: An AsyncLimiter for the endpoint being fetched from, shared by everything fetching from it
+    :return: The all_tokens dict populated for each token
+    """
+    missing_tokens = {
+        token.token: token for token in all_tokens.values() if getattr(token, key) is None
+    }
+    if not missing_tokens:
+        return all_tokens
+
+    async with create_client_fn() as client:
+        await get_data_fn(client, missing_tokens, limiter)
+    # Only the tokens that were missing data can have changed, so they're all that needs writing to the cache
+    token_cache.save(missing_tokens)
     return all_tokens
 
 
@@ -253,11 +377,7 @@ def holder_counts(all_tokens: dict) -> str:
     :param all_tokens: The preassembled data dict for all tokens
     :return: A string containing the formatted output
     """
-    counts = {}
-    for token in all_tokens.values():
-        if not counts.get(token.holder_address):
-            counts[token.holder_address] = 0
-        counts[token.holder_address] += 1
+    counts = Counter(token.holder_address for token in all_tokens.values())
 
     return output.format_biggest_holders(len(all_tokens), counts)
 
@@ -321,7 +441,8 @@ if __name__ == "__main__":
         "--file",
         dest="outfile_name",
         default="snapshot.csv",
-        help="write snapshot to FILE (defaults to snapshot.csv)",
+        help="write snapshot to FILE (defaults to snapshot.csv, use a .parquet or .feather extension to write "
+        "those formats instead)",
         metavar="SNAP_FILE",
     )
     parser.add_argument(
@@ -353,6 +474,14 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
+    # Use uvloop's faster event loop if it's installed (it's optional, and not available on Windows)
+    try:
+        import uvloop
+
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        logger.debug("uvloop not installed, using the default asyncio event loop")
+
     main(
         args.token_list,
         args.holder_counts,
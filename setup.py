@@ -22,11 +22,15 @@ setuptools.setup(
         "aiohttp",
         "aiolimiter",
         "asyncio",
-        "base58",
+        "based58",
+        "ijson",
+        "orjson",
         "pandas",
+        "pyarrow",
+        "requests",
         "retry",
         "solana",
         "tqdm",
     ],
-    tests_require=["mock", "pytest", "pytest-mock"],
+    tests_require=["base58", "mock", "pytest", "pytest-mock"],
 )
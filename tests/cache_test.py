@@ -1,8 +1,7 @@
-import pickle
-
 import mock
 
 from util import cache
+from util.token import Token
 
 
 class TestCache:
@@ -20,26 +19,60 @@ class TestCache:
             file_mock.assert_called_once_with("tokenfile")
         assert result == expected
 
-    def test_load_request_cache(self, mocker):
-        test_cache_data = {"test": "result"}
-        pickle_mock = mocker.patch("pickle.load")
-        pickle_mock.return_value = test_cache_data
-
-        file_mock = mock.mock_open(read_data=pickle.dumps(test_cache_data))
-        with mock.patch("pathlib.Path.open", file_mock) as path_mock:
-            cache.token_cache.initialize("test")
-            config = cache.token_cache.load()
-            path_mock.assert_called_once()
-            pickle_mock.assert_called_once_with(file_mock())
-        assert config == test_cache_data
-
-    def test_save_request_cache(self, mocker):
-        test_cache_data = {"test": "result"}
-        pickle_mock = mocker.patch("pickle.dump")
-
-        file_mock = mock.mock_open(read_data=pickle.dumps(test_cache_data))
-        with mock.patch("pathlib.Path.open", file_mock) as path_mock:
-            cache.token_cache.initialize("test")
-            cache.token_cache.save(test_cache_data)
-            path_mock.assert_called_once()
-        pickle_mock.assert_called_once_with(test_cache_data, file_mock())
+    def test_dump_and_load_token(self):
+        token = Token(token="1", name="Token #1", amount="1", traits={"hair": "white"})
+        token.rank = 1
+
+        result = cache.load_token(cache.dump_token(token))
+        assert vars(result) == {**vars(token), "rank": None}
+
+    def test_load_request_cache(self, mocker, tmp_path):
+        mocker.patch.object(cache, "CACHE_DIR", tmp_path)
+        test_cache_data = {"1": Token(token="1", name="Token #1"), "2": Token(token="2")}
+
+        cache.token_cache.initialize("test")
+        cache.token_cache.save(test_cache_data)
+        result = cache.token_cache.load()
+        assert result.keys() == test_cache_data.keys()
+        assert result["1"].name == "Token #1"
+        assert result["2"].name is None
+
+    def test_load_request_cache_empty(self, mocker, tmp_path):
+        mocker.patch.object(cache, "CACHE_DIR", tmp_path)
+
+        cache.token_cache.initialize("test")
+        assert cache.token_cache.load() == {}
+
+    def test_save_request_cache(self, mocker, tmp_path):
+        mocker.patch.object(cache, "CACHE_DIR", tmp_path)
+
+        cache.token_cache.initialize("test")
+        cache.token_cache.save({"1": Token(token="1"), "2": Token(token="2")})
+        cache.token_cache.save({"1": Token(token="1", name="Token #1")})
+        result = cache.token_cache.load()
+        assert result.keys() == {"1", "2"}
+        assert result["1"].name == "Token #1"
+        assert (tmp_path / "test_cache.db").exists()
+
+    def test_clear_request_cache(self, mocker, tmp_path):
+        mocker.patch.object(cache, "CACHE_DIR", tmp_path)
+
+        cache.token_cache.initialize("test")
+        cache.token_cache.save({"1": Token(token="1")})
+        cache.token_cache.clear()
+        assert cache.token_cache.load() == {}
+
+    def test_clear_request_cache_corrupt(self, mocker, tmp_path):
+        mocker.patch.object(cache, "CACHE_DIR", tmp_path)
+
+        cache.token_cache.initialize("test")
+        (tmp_path / "test_cache.db").write_bytes(b"this is not a database" * 100)
+        (tmp_path / "test_cache.db-wal").write_bytes(b"junk")
+        assert cache.token_cache.load() == {}
+
+        cache.token_cache.clear()
+        assert not (tmp_path / "test_cache.db-wal").exists()
+        cache.token_cache.save({"1": Token(token="1", name="Token #1")})
+        result = cache.token_cache.load()
+        assert result.keys() == {"1"}
+        assert result["1"].name == "Token #1"
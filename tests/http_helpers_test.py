@@ -1,6 +1,8 @@
 import aiohttp
 import mock
 import pytest
+from tenacity import stop_after_attempt
+from tenacity import wait_none
 
 from util import http_helpers
 
@@ -10,6 +12,9 @@ class TestHttpHelpers:
     async def test_create_http_client(self):
         result = http_helpers.create_http_client()
         assert isinstance(result, aiohttp.ClientSession)
+        assert result.connector.limit == http_helpers.CONNECTION_LIMIT
+        assert result.connector.limit_per_host == 0
+        await result.close()
 
     @pytest.mark.asyncio
     async def test_async_http_request(self, mocker):
@@ -17,12 +22,69 @@ class TestHttpHelpers:
         session_mock = mocker.MagicMock(aiohttp.ClientSession)
         response_mock = mocker.Mock(aiohttp.ClientResponse)
         response_mock.status = 200
-        response_mock.json = mock.AsyncMock()
-        result_json = "This is just a test response"
-        response_mock.json.return_value = result_json
+        response_mock.read = mock.AsyncMock()
+        response_mock.read.return_value = b'{"image": "This is just a test response"}'
         session_mock.get.return_value.__aenter__.return_value = response_mock
 
         result = await http_helpers.async_http_request(session_mock, test_url)
         session_mock.get.assert_called_once_with(test_url)
-        response_mock.json.assert_called_once()
-        assert result == result_json
+        response_mock.read.assert_called_once()
+        assert result == {"image": "This is just a test response"}
+
+    @pytest.mark.asyncio
+    async def test_async_http_request_failure(self, mocker):
+        mocker.patch.object(http_helpers.async_http_request.retry, "stop", stop_after_attempt(2))
+        mocker.patch.object(http_helpers.async_http_request.retry, "wait", wait_none())
+        test_url = "http://www.example.com"
+        session_mock = mocker.MagicMock(aiohttp.ClientSession)
+        response_mock = mocker.Mock(aiohttp.ClientResponse)
+        response_mock.status = 500
+        response_mock.text = mock.AsyncMock(return_value="Internal Server Error")
+        session_mock.get.return_value.__aenter__.return_value = response_mock
+
+        with pytest.raises(http_helpers.RequestFailedError):
+            await http_helpers.async_http_request(session_mock, test_url)
+        assert session_mock.get.call_count == 2
+        assert response_mock.text.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test_async_http_request_not_retried(self, mocker):
+        test_url = "http://www.example.com"
+        session_mock = mocker.MagicMock(aiohttp.ClientSession)
+        response_mock = mocker.Mock(aiohttp.ClientResponse)
+        response_mock.status = 200
+        response_mock.read = mock.AsyncMock(return_value=b"<html>not JSON</html>")
+        session_mock.get.return_value.__aenter__.return_value = response_mock
+
+        with pytest.raises(ValueError):
+            await http_helpers.async_http_request(session_mock, test_url)
+        session_mock.get.assert_called_once_with(test_url)
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("status", [400, 401, 403, 410])
+    async def test_async_http_request_rejected(self, mocker, status):
+        test_url = "http://www.example.com"
+        session_mock = mocker.MagicMock(aiohttp.ClientSession)
+        response_mock = mocker.Mock(aiohttp.ClientResponse)
+        response_mock.status = status
+        response_mock.text = mock.AsyncMock(return_value="Nope")
+        session_mock.get.return_value.__aenter__.return_value = response_mock
+
+        with pytest.raises(http_helpers.RequestRejectedError):
+            await http_helpers.async_http_request(session_mock, test_url)
+        session_mock.get.assert_called_once_with(test_url)
+
+    @pytest.mark.asyncio
+    async def test_async_http_request_timeout_status_retried(self, mocker):
+        mocker.patch.object(http_helpers.async_http_request.retry, "stop", stop_after_attempt(2))
+        mocker.patch.object(http_helpers.async_http_request.retry, "wait", wait_none())
+        test_url = "http://www.example.com"
+        session_mock = mocker.MagicMock(aiohttp.ClientSession)
+        response_mock = mocker.Mock(aiohttp.ClientResponse)
+        response_mock.status = 408
+        response_mock.text = mock.AsyncMock(return_value="Request Timeout")
+        session_mock.get.return_value.__aenter__.return_value = response_mock
+
+        with pytest.raises(http_helpers.RequestFailedError):
+            await http_helpers.async_http_request(session_mock, test_url)
+        assert session_mock.get.call_count == 2
@@ -0,0 +1,11 @@
+import base58
+
+from util import metadata
+
+
+class TestMetadata:
+    def test_create_metadata_instruction_data_with_str_creators(self):
+        creator = "7z1YPxYiKK3c8ZgC4eEaA3dZDCb88LK34Nk4yGBeZnao"
+
+        result = metadata.create_metadata_instruction_data("Name", "SYM", 500, [creator])
+        assert base58.b58decode(creator) in result
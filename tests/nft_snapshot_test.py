@@ -1,3 +1,5 @@
+import asyncio
+
 import mock
 import pytest
 from aiolimiter import AsyncLimiter
@@ -129,26 +131,30 @@ class TestNftSnapshot:
             )
 
     def test_main_bust_cache(self, mocker):
-        cache_mock = mocker.patch.object(nft_snapshot.token_cache, "save")
+        cache_mock = mocker.patch.object(nft_snapshot.token_cache, "clear")
+        load_mock = mocker.patch.object(nft_snapshot.token_cache, "load")
         rtl_mock = mocker.patch.object(nft_snapshot, "read_token_list")
         rtl_mock.return_value = []
 
         nft_snapshot.main(
             False, False, False, False, False, "test_cm", "", False, "outfile", "tokenfile", True
         )
-        cache_mock.assert_called_once_with({})
+        cache_mock.assert_called_once_with()
+        load_mock.assert_not_called()
 
     def test_populate_holders_details_async(self, mocker):
         cache_mock = mocker.patch.object(nft_snapshot.token_cache, "save")
         fetch_mock = mocker.patch.object(nft_snapshot, "fetch_token_data_from_network_async")
-        holder_mock = mocker.patch.object(nft_snapshot.sh, "get_holder_account_info_from_solana")
+        batch_mock = mocker.patch.object(
+            nft_snapshot, "fetch_batched_token_data_from_network_async"
+        )
         input_dict = {
             "token_1": Token(token="token_1"),
             "token_2": Token(token="token_2"),
             "token_3": Token(token="token_3"),
         }
         fetch_mock.return_value = input_dict
-        holder_mock.return_value = input_dict
+        batch_mock.return_value = input_dict
 
         result = nft_snapshot.populate_holders_details_async(input_dict)
         fetch_mock.assert_called_once_with(
@@ -156,47 +162,226 @@ class TestNftSnapshot:
             input_dict,
             "token_account",
             sh.get_token_account_from_solana_async,
+            mock.ANY,
+        )
+        batch_mock.assert_called_once_with(
+            sh.create_solana_client,
+            input_dict,
+            "holder_address",
+            sh.get_holder_account_info_from_solana_async,
+            mock.ANY,
         )
-        holder_mock.assert_called_once_with(input_dict)
-        assert cache_mock.call_count == 2
+        # Both steps hit the Solana RPC, so they should share a rate limit
+        assert isinstance(fetch_mock.call_args.args[4], AsyncLimiter)
+        assert fetch_mock.call_args.args[4] is batch_mock.call_args.args[4]
+        # Each step saves just the tokens it fetched itself, so there's no need to rewrite everything after it
+        cache_mock.assert_not_called()
         assert result == input_dict
 
     def test_populate_account_details_async(self, mocker):
         cache_mock = mocker.patch.object(nft_snapshot.token_cache, "save")
         fetch_mock = mocker.patch.object(nft_snapshot, "fetch_token_data_from_network_async")
+        batch_mock = mocker.patch.object(
+            nft_snapshot, "fetch_batched_token_data_from_network_async"
+        )
         input_dict = {
             "token_1": Token(token="token_1"),
             "token_2": Token(token="token_2"),
             "token_3": Token(token="token_3"),
         }
         fetch_mock.return_value = input_dict
+        batch_mock.return_value = input_dict
 
         result = nft_snapshot.populate_account_details_async(input_dict)
-        fetch_mock.assert_has_calls(
-            (
-                mock.call(
-                    sh.create_solana_client,
-                    input_dict,
-                    "name",
-                    sh.get_account_info_from_solana_async,
-                ),
-                mock.call(
-                    hh.create_http_client, input_dict, "image", nft_snapshot.get_arweave_metadata
-                ),
-            )
+        batch_mock.assert_called_once_with(
+            sh.create_solana_client, input_dict, "name", mock.ANY, mock.ANY
         )
-        assert cache_mock.call_count == 2
+        assert batch_mock.call_args.args[3].func == sh.get_metadata_account_info_from_solana_async
+        fetch_mock.assert_called_once_with(
+            hh.create_http_client,
+            input_dict,
+            "image",
+            nft_snapshot.get_arweave_metadata,
+            mock.ANY,
+            mock.ANY,
+        )
+        # Each step saves just the tokens it fetched itself, so there's no need to rewrite everything after it
+        cache_mock.assert_not_called()
+        assert result == input_dict
+
+    def test_populate_account_details_async_overlaps_steps(self, mocker):
+        mocker.patch.object(nft_snapshot.token_cache, "save")
+        input_dict = {
+            "token_1": Token(token="token_1", name="Token #1"),
+            "token_2": Token(token="token_2"),
+            "token_3": Token(token="token_3"),
+            "token_4": Token(token="token_4", name="Token #4", image="image"),
+        }
+        fetched_tokens = []
+
+        async def fetch_fn(create_client_fn, all_tokens, key, get_data_fn, limiter, ready_tokens):
+            while (token := await ready_tokens.get()) is not None:
+                fetched_tokens.append(token.token)
+            return all_tokens
+
+        async def batch_fn(create_client_fn, all_tokens, key, get_data_fn, limiter):
+            # token_1's metadata is cached, so it should already be on its way
+            await asyncio.sleep(0)
+            assert fetched_tokens == ["token_1"]
+            # Only token_2 gets its metadata, and it should be handed over before this step finishes
+            input_dict["token_2"].name = "Token #2"
+            get_data_fn.keywords["on_token_done"](input_dict["token_2"])
+            await asyncio.sleep(0)
+            assert fetched_tokens == ["token_1", "token_2"]
+            return all_tokens
+
+        mocker.patch.object(nft_snapshot, "fetch_token_data_from_network_async", fetch_fn)
+        mocker.patch.object(nft_snapshot, "fetch_batched_token_data_from_network_async", batch_fn)
+
+        result = nft_snapshot.populate_account_details_async(input_dict)
+        # token_3's metadata never came in, so it's left for the next run rather than marked as having no image
+        assert fetched_tokens == ["token_1", "token_2"]
+        assert input_dict["token_3"].image is None
         assert result == input_dict
 
+    def test_populate_account_details_async_retries_failed_metadata(self, mocker):
+        mocker.patch.object(nft_snapshot.token_cache, "save")
+        mocker.patch.object(sh, "create_solana_client", mocker.MagicMock)
+        mocker.patch.object(hh, "create_http_client", mocker.MagicMock)
+        mocker.patch.object(sh, "derive_metadata_accounts_async", return_value=["metadata_1"])
+        chunk_mock = mocker.patch.object(sh, "_get_multiple_accounts_chunk")
+        chunk_mock.side_effect = [RuntimeError("test"), [{"data": ["AA=="]}]]
+        mocker.patch.object(
+            sh.metadata,
+            "unpack_metadata_account",
+            return_value={"data": {"name": "X #1", "uri": "https://a"}},
+        )
+        request_mock = mocker.patch.object(hh, "async_http_request")
+        request_mock.return_value = {
+            "image": "https://a/image.png",
+            "attributes": [{"trait_type": "hat", "value": "red"}],
+        }
+        input_token = Token(token="token_1")
+
+        # The metadata request fails, so the token shouldn't be marked as having no image
+        nft_snapshot.populate_account_details_async({"token_1": input_token})
+        request_mock.assert_not_called()
+        assert input_token.name is None
+        assert input_token.image is None
+
+        # ...and so the next run fetches everything for it
+        nft_snapshot.populate_account_details_async({"token_1": input_token})
+        request_mock.assert_called_once_with(mock.ANY, "https://a")
+        assert input_token.name == "X #1"
+        assert input_token.image == "https://a/image.png"
+        assert input_token.traits == {"hat": "red"}
+
     @pytest.mark.asyncio
     async def test_fetch_token_data_from_network_async(self, mocker):
+        mocker.patch.object(nft_snapshot.token_cache, "save")
         input_token = Token(token="test_token", token_account="")
         input_dict = {"test_token": input_token}
 
         test_fn = mocker.AsyncMock()
         result = await nft_snapshot.fetch_token_data_from_network_async(
-            hh.create_http_client, input_dict, "token_account", test_fn
+            hh.create_http_client, input_dict, "token_account", test_fn, AsyncLimiter(1000, 1)
+        )
+        assert result == input_dict
+
+    @pytest.mark.asyncio
+    async def test_fetch_token_data_from_network_async_isolates_failures(self, mocker):
+        cache_mock = mocker.patch.object(nft_snapshot.token_cache, "save")
+        input_dict = {
+            "token_1": Token(token="token_1"),
+            "token_2": Token(token="token_2"),
+        }
+
+        async def test_fn(client, token, limiter):
+            if token.token == "token_1":
+                raise RuntimeError("test")
+            token.token_account = "account"
+            return token
+
+        result = await nft_snapshot.fetch_token_data_from_network_async(
+            hh.create_http_client, input_dict, "token_account", test_fn, AsyncLimiter(1000, 1)
+        )
+        assert result == input_dict
+        assert input_dict["token_1"].token_account is None
+        assert input_dict["token_2"].token_account == "account"
+        cache_mock.assert_called_once_with({"token_2": input_dict["token_2"]})
+
+    @pytest.mark.asyncio
+    async def test_fetch_token_data_from_network_async_with_ready_tokens(self, mocker):
+        mocker.patch.object(nft_snapshot.token_cache, "save")
+        input_dict = {
+            "token_1": Token(token="token_1"),
+            "token_2": Token(token="token_2"),
+        }
+        ready_tokens = asyncio.Queue()
+        ready_tokens.put_nowait(input_dict["token_2"])
+        ready_tokens.put_nowait(None)
+
+        async def test_fn(client, token, limiter):
+            token.token_account = "account"
+            return token
+
+        result = await nft_snapshot.fetch_token_data_from_network_async(
+            hh.create_http_client,
+            input_dict,
+            "token_account",
+            test_fn,
+            AsyncLimiter(1000, 1),
+            ready_tokens,
+        )
+        assert result == input_dict
+        assert input_dict["token_1"].token_account is None
+        assert input_dict["token_2"].token_account == "account"
+
+    @pytest.mark.asyncio
+    async def test_fetch_token_data_from_network_async_all_cached(self, mocker):
+        cache_mock = mocker.patch.object(nft_snapshot.token_cache, "save")
+        input_dict = {"test_token": Token(token="test_token", token_account="account")}
+
+        client_fn = mocker.Mock()
+        test_fn = mocker.AsyncMock()
+        result = await nft_snapshot.fetch_token_data_from_network_async(
+            client_fn, input_dict, "token_account", test_fn, AsyncLimiter(1000, 1)
+        )
+        client_fn.assert_not_called()
+        test_fn.assert_not_called()
+        cache_mock.assert_not_called()
+        assert result == input_dict
+
+    @pytest.mark.asyncio
+    async def test_fetch_batched_token_data_from_network_async(self, mocker):
+        cache_mock = mocker.patch.object(nft_snapshot.token_cache, "save")
+        input_dict = {
+            "token_1": Token(token="token_1"),
+            "token_2": Token(token="token_2", name="Token #2"),
+        }
+
+        test_fn = mocker.AsyncMock()
+        result = await nft_snapshot.fetch_batched_token_data_from_network_async(
+            hh.create_http_client, input_dict, "name", test_fn, AsyncLimiter(1000, 1)
+        )
+        test_fn.assert_called_once()
+        assert test_fn.call_args.args[1] == {"token_1": input_dict["token_1"]}
+        cache_mock.assert_called_once_with({"token_1": input_dict["token_1"]})
+        assert result == input_dict
+
+    @pytest.mark.asyncio
+    async def test_fetch_batched_token_data_from_network_async_all_cached(self, mocker):
+        cache_mock = mocker.patch.object(nft_snapshot.token_cache, "save")
+        input_dict = {"token_1": Token(token="token_1", name="Token #1")}
+
+        client_fn = mocker.Mock()
+        test_fn = mocker.AsyncMock()
+        result = await nft_snapshot.fetch_batched_token_data_from_network_async(
+            client_fn, input_dict, "name", test_fn, AsyncLimiter(1000, 1)
         )
+        client_fn.assert_not_called()
+        test_fn.assert_not_called()
+        cache_mock.assert_not_called()
         assert result == input_dict
 
     @pytest.mark.asyncio
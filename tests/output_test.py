@@ -1,3 +1,5 @@
+import pandas
+
 from util import output
 from util.token import Token
 
@@ -92,7 +94,13 @@ holder_2: 6 (6/7, 0.857143)
         result = output.sort_dict_by_values(input_dict, reverse=True)
         assert result == expected
 
-    def test_holder_snapshot(self, mocker):
+    def test_sort_dict_by_values_keeps_order_of_ties(self):
+        input_dict = {"b": 1, "a": 1, "c": 2}
+
+        assert list(output.sort_dict_by_values(input_dict)) == ["b", "a", "c"]
+        assert list(output.sort_dict_by_values(input_dict, reverse=True)) == ["c", "b", "a"]
+
+    def test_holder_snapshot(self, tmp_path):
         input_dict = {
             "token_addr_1": Token(
                 token="token_addr_1",
@@ -128,11 +136,61 @@ holder_2: 6 (6/7, 0.857143)
                 "Value1",
             ]
         ]
-        test_outfile_name = "outfile.csv"
-        pd_mock = mocker.patch("pandas.DataFrame")
-        output.holder_snapshot(input_dict, test_outfile_name)
-        pd_mock.assert_called_once_with(expected, columns=headers)
-        pd_mock.return_value.to_csv.assert_called_once_with(test_outfile_name)
+        test_outfile_name = tmp_path / "outfile.csv"
+        output.holder_snapshot(input_dict, str(test_outfile_name))
+        result = pandas.read_csv(test_outfile_name, index_col=0, dtype=str, keep_default_na=False)
+        assert list(result.columns) == headers
+        assert result.values.tolist() == [[str(value) for value in row] for row in expected]
+
+    def test_holder_snapshot_columnar(self, tmp_path):
+        input_dict = {
+            "token_addr_1": Token(
+                token="token_addr_1",
+                holder_address="owner_1",
+                amount=1,
+                name="Token #1",
+                id="1",
+                traits={"Trait1": "Value1"},
+            ),
+            "token_addr_2": Token(
+                token="token_addr_2",
+                holder_address="owner_2",
+                amount=1,
+                name="Token #2",
+                id="2",
+                traits={"Trait1": 5},
+            ),
+        }
+        for outfile_name, read_fn in (
+            ("outfile.parquet", pandas.read_parquet),
+            ("outfile.feather", pandas.read_feather),
+        ):
+            output.holder_snapshot(input_dict, str(tmp_path / outfile_name))
+            result = read_fn(tmp_path / outfile_name)
+            assert list(result["Token"]) == ["token_addr_1", "token_addr_2"]
+            assert list(result["Trait1"]) == ["Value1", "5"]
+
+    def test_holder_snapshot_columnar_with_clashing_trait(self, tmp_path):
+        input_dict = {
+            "token_addr_1": Token(
+                token="token_addr_1",
+                holder_address="owner_1",
+                amount=1,
+                name="Token #1",
+                id="1",
+                image="https://www.iana.org/_img/2022/iana-logo-header.svg",
+                traits={"Image": "Sunset", "Trait1": "Value1"},
+            )
+        }
+        for outfile_name, read_fn in (
+            ("outfile.parquet", pandas.read_parquet),
+            ("outfile.feather", pandas.read_feather),
+        ):
+            output.holder_snapshot(input_dict, str(tmp_path / outfile_name))
+            result = read_fn(tmp_path / outfile_name)
+            assert list(result.columns[-2:]) == ["trait_Image", "Trait1"]
+            assert list(result["Image"]) == ["https://www.iana.org/_img/2022/iana-logo-header.svg"]
+            assert list(result["trait_Image"]) == ["Sunset"]
 
     def test_get_trait_map(self):
         input_dict = {
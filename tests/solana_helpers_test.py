@@ -1,44 +1,177 @@
+import asyncio
 import base64
+import io
 
 import aiolimiter
 import base58
+import orjson
 import pytest
 from solana.rpc.async_api import AsyncClient
 
+from util import metadata
 from util import solana_helpers
 from util.token import Token
 
 
+def respond_by_chunk(responses: dict):
+    """Build a mock side_effect that picks each response (or exception to raise) by the chunk of addresses requested,
+    so tests don't depend on the order chunks happen to be fetched in
+
+    :param responses: dict mapping tuples of addresses to responses
+    :return: The side_effect function
+    """
+
+    def side_effect(*args, **kwargs):
+        response = responses[tuple(next(arg for arg in args if isinstance(arg, list)))]
+        if isinstance(response, BaseException):
+            raise response
+        return response
+
+    return side_effect
+
+
 class TestSolanaHelpers:
     def test_get_token_list_from_candymachine_id(self, mocker):
-        client_mock = mocker.patch("solana.rpc.api.Client")
-        client_mock.return_value.get_program_accounts.return_value = {
-            "result": [{"account": {"data": [base64.b64encode(b"0" * 33 + b"123456789")]}}]
-        }
+        post_mock = mocker.patch("requests.post")
+        post_mock.return_value.__enter__.return_value.raw = io.BytesIO(
+            orjson.dumps(
+                {
+                    "result": [
+                        {
+                            "account": {
+                                "data": [
+                                    base64.b64encode(b"0" * 33 + b"123456789").decode(),
+                                    "base64",
+                                ]
+                            }
+                        }
+                    ]
+                }
+            )
+        )
         test_cm_id = "4wTTi885HkQ6awqRGQkHAdXXzE46DyqLNXtfo1uz5ub3"  # Mindfolk
         expected = [base58.b58encode("123456789").decode()]
 
         result = solana_helpers.get_token_list_from_candymachine_id(test_cm_id)
-        client_mock.assert_called_once_with("https://rpc.theindex.io", timeout=30)
-        client_mock.return_value.get_program_accounts.assert_called_once()
+        post_mock.assert_called_once()
+        assert post_mock.call_args.args == ("https://rpc.theindex.io",)
+        memcmp = post_mock.call_args.kwargs["json"]["params"][1]["filters"][0]["memcmp"]
+        assert memcmp["bytes"] == test_cm_id
         assert result == expected
 
     def test_get_token_list_from_candymachine_id_v2(self, mocker):
-        client_mock = mocker.patch("solana.rpc.api.Client")
-        client_mock.return_value.get_program_accounts.return_value = {
-            "result": [{"account": {"data": [base64.b64encode(b"0" * 33 + b"123456789")]}}]
-        }
+        post_mock = mocker.patch("requests.post")
+        post_mock.return_value.__enter__.return_value.raw = io.BytesIO(
+            orjson.dumps(
+                {
+                    "result": [
+                        {
+                            "account": {
+                                "data": [
+                                    base64.b64encode(b"0" * 33 + b"123456789").decode(),
+                                    "base64",
+                                ]
+                            }
+                        }
+                    ]
+                }
+            )
+        )
         test_cm_id = "HHGsTSzwPpYMYDGgUqssgAsMZMsYbshgrhMge8Ypgsjx"  # DTP CMv2
         expected = [base58.b58encode("123456789").decode()]
 
         result = solana_helpers.get_token_list_from_candymachine_id(test_cm_id, use_v2=True)
-        client_mock.assert_called_once_with("https://rpc.theindex.io", timeout=30)
-        client_mock.return_value.get_program_accounts.assert_called_once()
+        post_mock.assert_called_once()
+        memcmp = post_mock.call_args.kwargs["json"]["params"][1]["filters"][0]["memcmp"]
+        assert memcmp["bytes"] != test_cm_id
+        assert result == expected
+
+    def test_parse_mints_from_program_accounts(self):
+        response = orjson.dumps(
+            {
+                "jsonrpc": "2.0",
+                "result": [
+                    {
+                        "account": {
+                            "data": [
+                                base64.b64encode(b"0" * 33 + bytes([i]) * 32).decode(),
+                                "base64",
+                            ]
+                        },
+                        "pubkey": "abc",
+                    }
+                    for i in range(3)
+                ],
+                "id": 1,
+            }
+        )
+        expected = [base58.b58encode(bytes([i]) * 32).decode() for i in range(3)]
+
+        result = list(solana_helpers.parse_mints_from_program_accounts(io.BytesIO(response)))
         assert result == expected
 
-    def test_create_solana_client(self):
+    def test_parse_mints_from_program_accounts_with_error(self):
+        response = orjson.dumps(
+            {"jsonrpc": "2.0", "error": {"code": -32600, "message": "nope"}, "id": 1}
+        )
+
+        with pytest.raises(RuntimeError):
+            list(solana_helpers.parse_mints_from_program_accounts(io.BytesIO(response)))
+
+    @pytest.mark.asyncio
+    async def test_create_solana_client(self):
         result = solana_helpers.create_solana_client()
-        assert isinstance(result, AsyncClient)
+        assert isinstance(result, solana_helpers.HedgedAsyncClient)
+        assert [client._provider.endpoint_uri for client in result.clients] == (
+            solana_helpers.ASYNC_RPC_ENDPOINTS
+        )
+        async with result:
+            pass
+
+    @staticmethod
+    def _hedged_client(mocker, *responses, hedge_delay=0.01):
+        client = solana_helpers.HedgedAsyncClient([], hedge_delay=hedge_delay)
+        client.clients = []
+        for response in responses:
+            client_mock = mocker.MagicMock(AsyncClient)
+            client_mock.get_balance.side_effect = response
+            client.clients.append(client_mock)
+        return client
+
+    @pytest.mark.asyncio
+    async def test_hedged_client_uses_first_endpoint(self, mocker):
+        client = self._hedged_client(mocker, [{"result": 1}], [{"result": 2}])
+
+        result = await client.get_balance("key")
+        assert result == {"result": 1}
+        client.clients[0].get_balance.assert_called_once_with("key")
+        client.clients[1].get_balance.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_hedged_client_hedges_slow_request(self, mocker):
+        async def slow_response(*args):
+            await asyncio.sleep(1)
+            return {"result": 1}
+
+        client = self._hedged_client(mocker, slow_response, [{"result": 2}])
+
+        result = await client.get_balance("key")
+        assert result == {"result": 2}
+        client.clients[1].get_balance.assert_called_once_with("key")
+
+    @pytest.mark.asyncio
+    async def test_hedged_client_fails_over_on_error(self, mocker):
+        client = self._hedged_client(mocker, RuntimeError("test"), [{"result": 2}], hedge_delay=10)
+
+        result = await client.get_balance("key")
+        assert result == {"result": 2}
+
+    @pytest.mark.asyncio
+    async def test_hedged_client_raises_when_all_fail(self, mocker):
+        client = self._hedged_client(mocker, RuntimeError("test1"), RuntimeError("test2"))
+
+        with pytest.raises(RuntimeError):
+            await client.get_balance("key")
 
     @pytest.mark.asyncio
     async def test_get_token_account_from_solana_async(self, mocker):
@@ -72,9 +205,89 @@ class TestSolanaHelpers:
         assert result == input_token
         assert input_token.token_account == ""
 
-    def test_get_holder_account_info_from_solana_async(self, mocker):
-        client_mock = mocker.patch("solana.rpc.api.Client")
-        client_mock.return_value.get_multiple_accounts.return_value = {
+    @pytest.mark.asyncio
+    async def test_batch_get_account_info(self, mocker):
+        client_mock = mocker.MagicMock(AsyncClient)
+        client_mock.get_multiple_accounts.side_effect = respond_by_chunk(
+            {
+                ("1", "2"): {"result": {"value": [{"data": "a"}, {"data": "b"}]}},
+                ("3",): {"result": {"value": [None]}},
+            }
+        )
+
+        result = await solana_helpers.batch_get_account_info(
+            client_mock, ["1", "2", "3"], aiolimiter.AsyncLimiter(1000, 1), batch_size=2
+        )
+        client_mock.get_multiple_accounts.assert_has_calls(
+            [
+                mocker.call(["1", "2"], encoding="jsonParsed"),
+                mocker.call(["3"], encoding="jsonParsed"),
+            ],
+            any_order=True,
+        )
+        assert result == {"1": {"data": "a"}, "2": {"data": "b"}, "3": None}
+
+    @pytest.mark.asyncio
+    async def test_batch_get_account_info_with_on_chunk_done(self, mocker):
+        chunk_mock = mocker.patch.object(solana_helpers, "_get_multiple_accounts_chunk")
+        chunk_mock.side_effect = respond_by_chunk(
+            {("1", "2"): [{"data": "a"}, None], ("3",): RuntimeError("test")}
+        )
+        on_chunk_done = mocker.Mock()
+
+        result = await solana_helpers.batch_get_account_info(
+            mocker.MagicMock(AsyncClient),
+            ["1", "2", "3"],
+            aiolimiter.AsyncLimiter(1000, 1),
+            batch_size=2,
+            on_chunk_done=on_chunk_done,
+        )
+        on_chunk_done.assert_called_once_with({"1": {"data": "a"}, "2": None})
+        assert result == {"1": {"data": "a"}, "2": None}
+
+    @pytest.mark.asyncio
+    async def test_batch_get_account_info_with_failed_on_chunk_done(self, mocker):
+        chunk_mock = mocker.patch.object(solana_helpers, "_get_multiple_accounts_chunk")
+        chunk_mock.side_effect = respond_by_chunk(
+            {("1", "2"): [{"data": "a"}, {"data": "b"}], ("3",): [{"data": "c"}]}
+        )
+
+        def fail_first_chunk(accounts: dict) -> None:
+            if "1" in accounts:
+                raise AssertionError()
+
+        on_chunk_done = mocker.Mock(side_effect=fail_first_chunk)
+
+        result = await solana_helpers.batch_get_account_info(
+            mocker.MagicMock(AsyncClient),
+            ["1", "2", "3"],
+            aiolimiter.AsyncLimiter(1000, 1),
+            batch_size=2,
+            on_chunk_done=on_chunk_done,
+        )
+        assert on_chunk_done.call_count == 2
+        assert result == {"3": {"data": "c"}}
+
+    @pytest.mark.asyncio
+    async def test_batch_get_account_info_with_failed_chunk(self, mocker):
+        chunk_mock = mocker.patch.object(solana_helpers, "_get_multiple_accounts_chunk")
+        chunk_mock.side_effect = respond_by_chunk(
+            {("1", "2"): RuntimeError("test"), ("3",): [{"data": "c"}]}
+        )
+
+        result = await solana_helpers.batch_get_account_info(
+            mocker.MagicMock(AsyncClient),
+            ["1", "2", "3"],
+            aiolimiter.AsyncLimiter(1000, 1),
+            batch_size=2,
+        )
+        assert chunk_mock.call_count == 2
+        assert result == {"3": {"data": "c"}}
+
+    @pytest.mark.asyncio
+    async def test_get_holder_account_info_from_solana_async(self, mocker):
+        client_mock = mocker.MagicMock(AsyncClient)
+        client_mock.get_multiple_accounts.return_value = {
             "result": {
                 "value": [
                     {"data": {"parsed": {"info": {"owner": "test1", "tokenAmount": {"amount": 1}}}}}
@@ -85,47 +298,87 @@ class TestSolanaHelpers:
         input_token = Token(token=test_token, token_account="token_account")
         input_dict = {test_token: input_token}
 
-        result = solana_helpers.get_holder_account_info_from_solana(input_dict)
-        client_mock.return_value.get_multiple_accounts.assert_called_with(
+        result = await solana_helpers.get_holder_account_info_from_solana_async(
+            client_mock, input_dict, aiolimiter.AsyncLimiter(1000, 1)
+        )
+        client_mock.get_multiple_accounts.assert_called_with(
             ["token_account"], encoding="jsonParsed"
         )
         assert result == input_dict
         assert input_token.amount == 1
         assert input_token.holder_address == "test1"
 
-    def test_get_holder_account_info_from_solana_async_with_no_holder(self, mocker):
+    @pytest.mark.asyncio
+    async def test_get_holder_account_info_from_solana_async_with_no_holder(self, mocker):
+        client_mock = mocker.MagicMock(AsyncClient)
         test_token = "7z1YPxYiKK3c8ZgC4eEaA3dZDCb88LK34Nk4yGBeZnao"  # Mindfolk Founders #176
         input_token = Token(token=test_token, token_account="")
         input_dict = {test_token: input_token}
 
-        result = solana_helpers.get_holder_account_info_from_solana(input_dict)
+        result = await solana_helpers.get_holder_account_info_from_solana_async(
+            client_mock, input_dict, aiolimiter.AsyncLimiter(1000, 1)
+        )
+        client_mock.get_multiple_accounts.assert_not_called()
         assert result == input_dict
         assert input_token.amount == 0
         assert input_token.holder_address == ""
 
-    def test_get_holder_account_info_from_solana_async_with_token_account_but_no_holder(
+    @pytest.mark.asyncio
+    async def test_get_holder_account_info_from_solana_async_without_token_account(self, mocker):
+        client_mock = mocker.MagicMock(AsyncClient)
+        test_token = "7z1YPxYiKK3c8ZgC4eEaA3dZDCb88LK34Nk4yGBeZnao"  # Mindfolk Founders #176
+        input_token = Token(token=test_token)
+        input_dict = {test_token: input_token}
+
+        result = await solana_helpers.get_holder_account_info_from_solana_async(
+            client_mock, input_dict, aiolimiter.AsyncLimiter(1000, 1)
+        )
+        client_mock.get_multiple_accounts.assert_not_called()
+        assert result == input_dict
+        assert input_token.holder_address is None
+
+    @pytest.mark.asyncio
+    async def test_get_holder_account_info_from_solana_async_with_token_account_but_no_holder(
         self, mocker
     ):
-        client_mock = mocker.patch("solana.rpc.api.Client")
-        client_mock.return_value.get_multiple_accounts.return_value = {"result": {"value": [{}]}}
+        client_mock = mocker.MagicMock(AsyncClient)
+        client_mock.get_multiple_accounts.return_value = {"result": {"value": [{}]}}
 
         test_token = "7z1YPxYiKK3c8ZgC4eEaA3dZDCb88LK34Nk4yGBeZnao"  # Mindfolk Founders #176
         input_token = Token(token=test_token, token_account="token_account")
         input_dict = {test_token: input_token}
 
-        result = solana_helpers.get_holder_account_info_from_solana(input_dict)
-        client_mock.return_value.get_multiple_accounts.assert_called_with(
+        result = await solana_helpers.get_holder_account_info_from_solana_async(
+            client_mock, input_dict, aiolimiter.AsyncLimiter(1000, 1)
+        )
+        client_mock.get_multiple_accounts.assert_called_with(
             ["token_account"], encoding="jsonParsed"
         )
         assert result == input_dict
         assert input_token.amount == 0
         assert input_token.holder_address == ""
 
+    def test_derive_metadata_accounts(self):
+        test_token = "7z1YPxYiKK3c8ZgC4eEaA3dZDCb88LK34Nk4yGBeZnao"  # Mindfolk Founders #176
+        result = solana_helpers.derive_metadata_accounts([test_token])
+        assert result == [str(metadata.get_metadata_account(test_token))]
+
     @pytest.mark.asyncio
-    async def test_get_account_info_from_solana_async(self, mocker):
+    async def test_derive_metadata_accounts_async_with_process_pool(self, mocker):
+        mocker.patch.object(solana_helpers, "PROCESS_POOL_THRESHOLD", 0)
+        test_tokens = [
+            "7z1YPxYiKK3c8ZgC4eEaA3dZDCb88LK34Nk4yGBeZnao",  # Mindfolk Founders #176
+            "4wTTi885HkQ6awqRGQkHAdXXzE46DyqLNXtfo1uz5ub3",
+            "HHGsTSzwPpYMYDGgUqssgAsMZMsYbshgrhMge8Ypgsjx",
+        ]
+        result = await solana_helpers.derive_metadata_accounts_async(test_tokens, chunk_size=2)
+        assert result == solana_helpers.derive_metadata_accounts(test_tokens)
+
+    @pytest.mark.asyncio
+    async def test_get_metadata_account_info_from_solana_async(self, mocker):
         client_mock = mocker.MagicMock(AsyncClient)
-        client_mock.get_account_info.return_value = {
-            "result": {"value": {"data": [base64.b64encode(b"123456789")]}}
+        client_mock.get_multiple_accounts.return_value = {
+            "result": {"value": [{"data": [base64.b64encode(b"123456789")]}]}
         }
         metadata_mock = mocker.patch.object(solana_helpers, "metadata")
         metadata_mock.get_metadata_account.return_value = "string1"
@@ -135,14 +388,65 @@ class TestSolanaHelpers:
 
         test_token = "7z1YPxYiKK3c8ZgC4eEaA3dZDCb88LK34Nk4yGBeZnao"  # Mindfolk Founders #176
         input_token = Token(token=test_token)
+        input_dict = {test_token: input_token}
 
-        result = await solana_helpers.get_account_info_from_solana_async(
-            client_mock, input_token, aiolimiter.AsyncLimiter(1000, 1)
+        on_token_done = mocker.Mock()
+        result = await solana_helpers.get_metadata_account_info_from_solana_async(
+            client_mock, input_dict, aiolimiter.AsyncLimiter(1000, 1), on_token_done
         )
+        on_token_done.assert_called_once_with(input_token)
         metadata_mock.get_metadata_account.assert_called_once_with(test_token)
-        client_mock.get_account_info.assert_called_once_with("string1")
+        client_mock.get_multiple_accounts.assert_called_once_with(["string1"], encoding="base64")
         metadata_mock.unpack_metadata_account.assert_called_once_with(b"123456789")
-        assert result == input_token
+        assert result == input_dict
         assert input_token.name == "String #2"
         assert input_token.id == "2"
         assert input_token.data_uri == "https://www.google.com"
+
+    @pytest.mark.asyncio
+    async def test_get_metadata_account_info_from_solana_async_with_bad_account(self, mocker):
+        client_mock = mocker.MagicMock(AsyncClient)
+        client_mock.get_multiple_accounts.return_value = {
+            "result": {
+                "value": [{"data": [base64.b64encode(b"1")]}, {"data": [base64.b64encode(b"2")]}]
+            }
+        }
+        metadata_mock = mocker.patch.object(solana_helpers, "metadata")
+        metadata_mock.get_metadata_account.side_effect = ["string1", "string2"]
+        metadata_mock.unpack_metadata_account.side_effect = [
+            {"data": {"name": "String #1", "uri": "https://www.google.com"}},
+            AssertionError(),
+        ]
+
+        input_dict = {"token_1": Token(token="token_1"), "token_2": Token(token="token_2")}
+
+        on_token_done = mocker.Mock()
+        result = await solana_helpers.get_metadata_account_info_from_solana_async(
+            client_mock, input_dict, aiolimiter.AsyncLimiter(1000, 1), on_token_done
+        )
+        # One bad account fails its whole chunk, so none of the chunk's tokens are touched
+        on_token_done.assert_not_called()
+        assert result == input_dict
+        assert input_dict["token_1"].name is None
+        assert input_dict["token_2"].name is None
+
+    @pytest.mark.asyncio
+    async def test_get_metadata_account_info_from_solana_async_with_no_account(self, mocker):
+        client_mock = mocker.MagicMock(AsyncClient)
+        client_mock.get_multiple_accounts.return_value = {"result": {"value": [None]}}
+        metadata_mock = mocker.patch.object(solana_helpers, "metadata")
+        metadata_mock.get_metadata_account.return_value = "string1"
+
+        test_token = "7z1YPxYiKK3c8ZgC4eEaA3dZDCb88LK34Nk4yGBeZnao"  # Mindfolk Founders #176
+        input_token = Token(token=test_token)
+        input_dict = {test_token: input_token}
+
+        on_token_done = mocker.Mock()
+        result = await solana_helpers.get_metadata_account_info_from_solana_async(
+            client_mock, input_dict, aiolimiter.AsyncLimiter(1000, 1), on_token_done
+        )
+        metadata_mock.unpack_metadata_account.assert_not_called()
+        # The account was looked up and isn't there, which still settles the token's metadata
+        on_token_done.assert_called_once_with(input_token)
+        assert result == input_dict
+        assert input_token.name is None
@@ -16,6 +16,18 @@ class TestToken:
         result = token.get_attribute_counts(trait_map, input_dict)
         assert result == expected
 
+    def test_get_attribute_counts_with_numeric_values(self):
+        input_dict = {
+            "token_1": token.Token(token="token_1", traits={"level": 5, "eyes": "blue"}),
+            "token_2": token.Token(token="token_2", traits={"eyes": "red"}),
+            "token_3": token.Token(token="token_3"),
+        }
+        trait_map = {"level": 0, "eyes": 1}
+        expected = (2, {"level": {5: 1, "": 1}, "eyes": {"blue": 1, "red": 1}})
+        result = token.get_attribute_counts(trait_map, input_dict)
+        assert result == expected
+        assert all(type(value) is int for value in result[1]["level"].values())
+
     def test_get_attribute_rarities(self):
         attr_counts = {
             "hair": {"white": 2, "": 1},
@@ -1,12 +1,20 @@
 import asyncio
 import logging
-import pickle
+import sqlite3
+from contextlib import closing
 from pathlib import Path
 
+import orjson
+
+from util.token import Token
+
 logger = logging.getLogger("nft_snapshot.util.cache")
 
 CACHE_DIR = "cache"
 
+# Rarity and rank are derived from the whole collection each run, so there's no point caching them
+UNCACHED_TOKEN_FIELDS = ("rarity", "rank")
+
 
 def write_token_list(token_file_name, token_list):
     """
@@ -28,6 +36,24 @@ def read_token_list(token_file_name) -> list[str]:
         return token_list_file.read().splitlines()
 
 
+def dump_token(token: Token) -> bytes:
+    """Serialize a token's fetched data for storage in the cache
+
+    :param token: The Token to serialize
+    :return: JSON bytes of the token's fields
+    """
+    return orjson.dumps({k: v for k, v in vars(token).items() if k not in UNCACHED_TOKEN_FIELDS})
+
+
+def load_token(data: bytes) -> Token:
+    """Deserialize a token previously serialized with dump_token()
+
+    :param data: JSON bytes of the token's fields
+    :return: The reconstructed Token
+    """
+    return Token(**orjson.loads(data))
+
+
 class TokenCache:
     filename: str
     path: Path
@@ -35,49 +61,81 @@ class TokenCache:
 
     def initialize(self, cache_file_key):
         self._initialized = True
-        self.filename = "{}_cache.p".format(cache_file_key)
+        self.filename = "{}_cache.db".format(cache_file_key)
 
         # Make sure the cache directory and file exist
         self.path = Path(CACHE_DIR)
         self.path.mkdir(exist_ok=True)
         self.path = self.path / self.filename
 
-    async def periodic_cache_task(self, all_tokens: dict):
+    def _connect(self) -> sqlite3.Connection:
+        """Open a connection to the cache database, creating the table if this is a fresh cache.
+
+        :return: sqlite3.Connection to the cache database
+        """
+        if not self._initialized:
+            raise RuntimeError("Trying to use cache before initializing it")
+
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS tokens (mint TEXT PRIMARY KEY, data BLOB)")
+        return conn
+
+    async def periodic_cache_task(self, pending_tokens: dict):
+        """Periodically write any tokens that have finished fetching to the cache, so progress survives a crash.
+
+        :param pending_tokens: dict of tokens waiting to be written, which is emptied on each write
+        """
         while True:
             await asyncio.sleep(20)
-            self.save(all_tokens)
+            self.save(pending_tokens)
+            pending_tokens.clear()
 
     def load(self) -> dict:
         """Load the previously-fetched data from the cache and return it.
 
         :return: dict filled with token data fetched from the cache
         """
-        if not self._initialized:
-            raise RuntimeError("Trying to use cache before initializing it")
-
         try:
-            with self.path.open("rb") as file:
-                all_tokens = pickle.load(file)
+            with closing(self._connect()) as conn:
+                all_tokens = {
+                    mint: load_token(data)
+                    for mint, data in conn.execute("SELECT mint, data FROM tokens")
+                }
                 logger.debug("Loaded cache data from %s", self.filename)
                 return all_tokens
         except Exception as e:
-            logger.debug("Unable to load cache file %s: %s", self.filename, e)
+            logger.warning(
+                "Unable to load cache file %s (use --bust-cache to reset it): %s", self.filename, e
+            )
             return {}
 
-    def save(self, all_tokens: dict) -> None:
-        """Save the passed-in dictionary data to the cache, overwriting current contents.
+    def save(self, tokens: dict) -> None:
+        """Save the passed-in tokens to the cache, replacing any cached data for those tokens.
 
-        :param all_tokens: The full set of token data to write to the cache
+        :param tokens: The token data to write to the cache
         """
-        if not self._initialized:
-            raise RuntimeError("Trying to use cache before initializing it")
-
         try:
-            with self.path.open("wb") as file:
-                pickle.dump(all_tokens, file)
-                logger.debug("Wrote cache data to %s", self.path)
+            with closing(self._connect()) as conn, conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO tokens (mint, data) VALUES (?, ?)",
+                    ((mint, dump_token(token)) for mint, token in tokens.items()),
+                )
+                logger.debug("Wrote %s tokens to cache %s", len(tokens), self.path)
         except Exception as e:
             logger.warning("Unable to write cache file %s: %s", self.filename, e)
 
+    def clear(self) -> None:
+        """Remove all token data from the cache by deleting the database, so this works even if it's corrupted. The
+        next connection creates it afresh.
+        """
+        if not self._initialized:
+            raise RuntimeError("Trying to use cache before initializing it")
+
+        # Take SQLite's write-ahead log and shared memory files along with it, or they'd be replayed into the new one
+        for suffix in ("", "-wal", "-shm"):
+            Path(f"{self.path}{suffix}").unlink(missing_ok=True)
+        logger.debug("Cleared cache %s", self.path)
+
 
 token_cache = TokenCache()
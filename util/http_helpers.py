@@ -1,15 +1,26 @@
+import asyncio
 import logging
 import resource
 
 import aiohttp
+import orjson
 from tenacity import after_log
 from tenacity import retry
+from tenacity import retry_if_exception_type
 from tenacity import stop_after_attempt
 from tenacity import wait_random_exponential
 
 
 logger = logging.getLogger("nft_snapshot.util.http_helpers")
 
+CONNECTION_LIMIT = 500
+
+# Request rate budget for fetching metadata from Arweave/IPFS
+MAX_REQUESTS_PER_SECOND = 100
+
+# Client error statuses that are still worth retrying (request timeout, and rate limiting)
+RETRYABLE_CLIENT_ERROR_STATUSES = (408, 429)
+
 
 class RateLimitingError(RuntimeError):
     pass
@@ -19,6 +30,20 @@ class RequestFailedError(RuntimeError):
     pass
 
 
+class RequestRejectedError(RuntimeError):
+    pass
+
+
+# Errors that might go away if the request is tried again, as opposed to e.g. a response body that won't parse, or
+# the server rejecting the request outright (RequestRejectedError)
+RETRYABLE_ERRORS = (
+    RateLimitingError,
+    RequestFailedError,
+    aiohttp.ClientError,
+    asyncio.TimeoutError,
+)
+
+
 def create_http_client() -> aiohttp.ClientSession:
     """Create the aiohttp client used to make asynchronous HTTP requests, configured to play nice with our needs
 
@@ -32,7 +57,10 @@ def create_http_client() -> aiohttp.ClientSession:
     except ValueError:
         logger.warning("Unable to raise open file limits")
 
-    conn = aiohttp.TCPConnector(limit=100)
+    # Keep the socket pool well above the request rate so the limiter, not the connector, is what throttles us
+    conn = aiohttp.TCPConnector(
+        limit=CONNECTION_LIMIT, limit_per_host=0, ttl_dns_cache=300, keepalive_timeout=75
+    )
     timeout = aiohttp.ClientTimeout(total=60)
     return aiohttp.ClientSession(connector=conn, timeout=timeout)
 
@@ -41,6 +69,8 @@ def create_http_client() -> aiohttp.ClientSession:
     stop=stop_after_attempt(10),
     after=after_log(logger, logging.DEBUG),
     wait=wait_random_exponential(min=4, max=32),
+    retry=retry_if_exception_type(RETRYABLE_ERRORS),
+    reraise=True,
 )
 async def async_http_request(session: aiohttp.ClientSession, url: str) -> dict:
     """Make an HTTP request to fetch a requested resource
@@ -61,11 +91,25 @@ async def async_http_request(session: aiohttp.ClientSession, url: str) -> dict:
                     "Got status code %s for url %s, has metadata been uploaded?", resp.status, url
                 )
                 return {}
-            else:
+            elif 400 <= resp.status < 500 and resp.status not in RETRYABLE_CLIENT_ERROR_STATUSES:
+                # The request itself is the problem, so trying it again won't help
                 logger.error(
-                    "HTTP request for %s failed with status %s: %s", url, resp.status, resp.json()
+                    "HTTP request for %s was rejected with status %s: %s",
+                    url,
+                    resp.status,
+                    await resp.text(),
+                )
+                raise RequestRejectedError()
+            else:
+                logger.warning(
+                    "HTTP request for %s failed with status %s, retrying: %s",
+                    url,
+                    resp.status,
+                    await resp.text(),
                 )
                 raise RequestFailedError()
         logging.debug("Successful response for url %s", url)
-        body = await resp.json()
-    return body
+        # Decode the raw body ourselves: orjson is much faster than resp.json(), and doesn't care if the server
+        # (e.g. some IPFS gateways) labels the JSON with a non-JSON content type
+        body = await resp.read()
+    return orjson.loads(body)
@@ -2,13 +2,14 @@
 # https://github.com/metaplex-foundation/python-api/blob/441c2ba9be76962d234d7700405358c72ee1b35b/metaplex/metadata.py
 # One modification: on line 157, I made creator values strings instead of bytes arrays to allow
 #   JSON serialization
-# Also ran black autoformatting on it, so it will look different
+# Also ran black autoformatting on it, so it will look different, and swapped base58 for the faster based58 since
+#   unpacking runs for every token
 import base64
 import struct
 from enum import IntEnum
 from typing import Union
 
-import base58
+import based58
 from construct import Bytes
 from construct import Flag
 from construct import Int8ul
@@ -91,7 +92,10 @@ def _get_data_buffer(name, symbol, uri, fee, creators, verified=None, share=None
         args.append(len(creators))
         for i, creator in enumerate(creators):
             byte_fmt += "B" * 32 + "B" + "B"
-            args.extend(list(base58.b58decode(creator)))
+            # based58 only takes bytes, unlike base58 which also accepted the str keys passed in here
+            args.extend(
+                list(based58.b58decode(creator.encode() if isinstance(creator, str) else creator))
+            )
             if isinstance(verified, list):
                 args.append(verified[i])
             else:
@@ -143,9 +147,9 @@ def create_metadata_instruction(data, update_authority, mint_key, mint_authority
 def unpack_metadata_account(data):
     assert data[0] == 4
     i = 1
-    source_account = base58.b58encode(bytes(struct.unpack("<" + "B" * 32, data[i : i + 32])))
+    source_account = based58.b58encode(bytes(struct.unpack("<" + "B" * 32, data[i : i + 32])))
     i += 32
-    mint_account = base58.b58encode(bytes(struct.unpack("<" + "B" * 32, data[i : i + 32])))
+    mint_account = based58.b58encode(bytes(struct.unpack("<" + "B" * 32, data[i : i + 32])))
     i += 32
     name_len = struct.unpack("<I", data[i : i + 4])[0]
     i += 4
@@ -172,7 +176,7 @@ def unpack_metadata_account(data):
         for _ in range(creator_len):
             # NOTE: I made this not a bytes array
             creator = str(
-                base58.b58encode(bytes(struct.unpack("<" + "B" * 32, data[i : i + 32]))), "UTF-8"
+                based58.b58encode(bytes(struct.unpack("<" + "B" * 32, data[i : i + 32]))), "UTF-8"
             )
             creators.append(creator)
             i += 32
@@ -1,3 +1,6 @@
+from operator import itemgetter
+from pathlib import Path
+
 import pandas
 
 from util.token import get_attribute_counts
@@ -14,6 +17,9 @@ MARKETPLACE_WALLETS = {
     "F4ghBzHFNgJxV4wEQDchU5i7n4XWWMBSaq7CuswGiVsr": "DigitalEyes",
 }
 
+# Snapshot file extensions that get written in a columnar format rather than CSV
+COLUMNAR_SUFFIXES = (".parquet", ".feather")
+
 
 def format_biggest_holders(tokens_total: int, counts: dict) -> str:
     """Format all the NFT holder wallets, sorted with the largest holders at the top
@@ -58,64 +64,75 @@ def format_trait_frequency(tokens_with_metadata_total: int, attribute_counts: di
 
 
 def sort_dict_by_values(dictionary: dict, reverse: bool = False) -> dict:
-    """Sort a dictionary by its values (default ascending)
+    """Sort a dictionary by its values (default ascending). Entries with equal values keep their original order.
 
     :param dictionary: dict to sort
     :param reverse: Whether to reverse sort order to descending
     :return: The sorted dictionary
     """
-    flipped_sorted_dict = sorted(((v, k) for (k, v) in dictionary.items()), reverse=reverse)
-    return dict([(k, v) for (v, k) in flipped_sorted_dict])
+    return dict(sorted(dictionary.items(), key=itemgetter(1), reverse=reverse))
 
 
 def holder_snapshot(all_tokens: dict, outfile_name: str) -> None:
-    """Output a CSV file containing data about each token in the collection.
+    """Output a file containing data about each token in the collection. Written as Parquet or Feather if
+    outfile_name has a .parquet or .feather extension, otherwise as CSV.
 
     :param all_tokens: A dict of all the token data in the collection
-    :param outfile_name: The name of the file to output the CSV to
+    :param outfile_name: The name of the file to output the snapshot to
     """
-    token_csv_data = []
-
     trait_map = get_trait_map(all_tokens)
     tokens_with_attributes_total, attribute_counts = get_attribute_counts(trait_map, all_tokens)
     attribute_rarities = get_attribute_rarities(tokens_with_attributes_total, attribute_counts)
 
     set_token_rarities_and_ranks(trait_map, attribute_rarities, all_tokens)
 
-    for token in all_tokens.values():
-        # Create a list big enough for all the collection's traits, then fill in the ones this NFT has
-        token_traits = [None] * len(trait_map)
-        for trait_name, trait_value in token.traits.items():
-            token_traits[trait_map[trait_name]] = trait_value
-        token_csv_data.append(
-            [
-                token.id,
-                token.name,
-                token.token,
-                token.holder_address if token.holder_address else "UNKNOWN_ADDRESS",
-                token.amount,
-                token.image,
-                token.rank,
-                "{:.20f}%".format(token.rarity * 100),
-            ]
-            + token_traits
-        )
-
-    dataset = pandas.DataFrame(
-        token_csv_data,
-        columns=[
-            "Number",
-            "TokenName",
-            "Token",
-            "HolderAddress",
-            "TotalHeld",
-            "Image",
-            "Rank",
-            "Rarity",
+    # Assemble the data a column at a time, so pandas doesn't have to transpose a list of rows
+    tokens = list(all_tokens.values())
+    fixed_column_names = [
+        "Number",
+        "TokenName",
+        "Token",
+        "HolderAddress",
+        "TotalHeld",
+        "Image",
+        "Rank",
+        "Rarity",
+    ]
+    column_values = [
+        [token.id for token in tokens],
+        [token.name for token in tokens],
+        [token.token for token in tokens],
+        [token.holder_address if token.holder_address else "UNKNOWN_ADDRESS" for token in tokens],
+        [token.amount for token in tokens],
+        [token.image for token in tokens],
+        [token.rank for token in tokens],
+        ["{:.20f}%".format(token.rarity * 100) for token in tokens],
+    ] + [[token.traits.get(trait_name) for token in tokens] for trait_name in trait_map]
+
+    # Pick the output format based on the file extension, falling back to CSV
+    suffix = Path(outfile_name).suffix.lower()
+    trait_column_names = list(trait_map.keys())
+    if suffix in COLUMNAR_SUFFIXES:
+        # Unlike CSV, columnar formats won't store two columns with the same name, so prefix any trait that shares
+        # its name with a fixed column
+        trait_column_names = [
+            f"trait_{trait_name}" if trait_name in fixed_column_names else trait_name
+            for trait_name in trait_column_names
         ]
-        + list(trait_map.keys()),
-    )
-    dataset.to_csv(outfile_name)
+
+    # Key the columns by position and name them afterwards, since a trait could share a name with a fixed column
+    dataset = pandas.DataFrame(dict(enumerate(column_values)))
+    dataset.columns = fixed_column_names + trait_column_names
+
+    if suffix in COLUMNAR_SUFFIXES:
+        # Trait values can be a mix of strings and numbers, which columnar formats won't store in one column
+        dataset = dataset.astype({trait_name: "string" for trait_name in trait_column_names})
+        if suffix == ".parquet":
+            dataset.to_parquet(outfile_name, compression="zstd")
+        else:
+            dataset.to_feather(outfile_name)
+    else:
+        dataset.to_csv(outfile_name)
 
 
 def get_trait_map(all_tokens: dict) -> dict:
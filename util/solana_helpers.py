@@ -1,14 +1,20 @@
+import asyncio
 import base64
 import itertools
 import logging
 import time
-
-import base58
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable
+from typing import Iterator
+from typing import Optional
+
+import based58
+import ijson
+import requests
 from aiolimiter import AsyncLimiter
 from solana.publickey import PublicKey
-from solana.rpc import api
 from solana.rpc import async_api
-from solana.rpc.types import MemcmpOpts
+from solana.rpc.types import RPCResponse
 from tenacity import after_log
 from tenacity import retry
 from tenacity import stop_after_attempt
@@ -29,6 +35,22 @@ SOLANA_RPC_ENDPOINT = "https://ssc-dao.genesysgo.net/"
 # Also much faster for requests it supports, so generally use this one
 GPA_RPC_ENDPOINT = "https://rpc.theindex.io"
 
+# Endpoints used for async requests, in order of preference. A request to one endpoint is hedged to the next if it's
+# slow or fails, so one provider having a bad day doesn't stall (or fail) the whole run
+ASYNC_RPC_ENDPOINTS = [GPA_RPC_ENDPOINT, SOLANA_RPC_ENDPOINT]
+
+# Request rate budget for the async RPC endpoints
+MAX_REQUESTS_PER_SECOND = 100
+
+# Seconds to wait on an RPC response before hedging the request to the next endpoint
+HEDGE_DELAY = 2.0
+
+# Most accounts getMultipleAccounts will return in a single call
+MAX_MULTIPLE_ACCOUNTS = 100
+
+# Below this many tokens, deriving metadata accounts inline is quicker than starting up worker processes
+PROCESS_POOL_THRESHOLD = 1000
+
 
 @retry(
     stop=stop_after_attempt(3),
@@ -47,8 +69,6 @@ def get_token_list_from_candymachine_id(cm_id: str, use_v2: bool = False) -> lis
 
     logger.info(f"Fetching tokens from CM {cm_id} (v2? {use_v2})")
 
-    client = api.Client(GPA_RPC_ENDPOINT, timeout=30)
-
     # Bunch of constants to get us looking in the right place...
     MAX_NAME_LENGTH = 32
     MAX_URI_LENGTH = 200
@@ -82,31 +102,185 @@ def get_token_list_from_candymachine_id(cm_id: str, use_v2: bool = False) -> lis
         )[0]
 
     # Set some options for exactly where to look within the data, and then fetch it
-    memcmp_opts = [MemcmpOpts(offset=CREATOR_ARRAY_START, bytes=str(cm_pk))]
     # NOTE: data_slice doesn't seem to do anything anymore, which seems...bad? Anyway, I just
     #     filter in the output below so we're all good.
     # data_slice_opts = DataSliceOpts(offset=33, length=32)
-    metadata_accounts = client.get_program_accounts(
-        TOKEN_METADATA_PROGRAM,
-        encoding="base64",
-        # data_slice=data_slice_opts,
-        data_size=MAX_METADATA_LEN,
-        memcmp_opts=memcmp_opts,
-    )
+    request_body = {
+        "jsonrpc": "2.0",
+        "id": 1,
+        "method": "getProgramAccounts",
+        "params": [
+            str(TOKEN_METADATA_PROGRAM),
+            {
+                "encoding": "base64",
+                "filters": [
+                    {"memcmp": {"offset": CREATOR_ARRAY_START, "bytes": str(cm_pk)}},
+                    {"dataSize": MAX_METADATA_LEN},
+                ],
+            },
+        ],
+    }
+    # The response holds the full data for every matched account, which runs to many MB for a big collection. Parse
+    # it as it streams in rather than loading it all, since we only keep the 32 byte mint key out of each account.
+    with requests.post(GPA_RPC_ENDPOINT, json=request_body, stream=True, timeout=30) as resp:
+        resp.raise_for_status()
+        resp.raw.decode_content = True
+        token_list = list(parse_mints_from_program_accounts(resp.raw))
     logging.info("--- %s seconds ---", (time.time() - start_time))
 
-    return [
-        str(base58.b58encode(base64.b64decode(v["account"]["data"][0])[33:65]), "UTF-8")
-        for v in metadata_accounts["result"]
-    ]
+    return token_list
+
 
+def parse_mints_from_program_accounts(response_stream) -> Iterator[str]:
+    """Incrementally parse a getProgramAccounts JSON-RPC response for metadata accounts, yielding the mint key of
+    each account as it's read
 
-def create_solana_client() -> async_api.AsyncClient:
+    :param response_stream: A file-like object containing the raw JSON response (with base64-encoded account data)
+    :return: An iterator over the token IDs
+    """
+    in_account_data = False
+    for prefix, event, value in ijson.parse(response_stream):
+        if prefix == "result.item.account.data" and event == "start_array":
+            # Account data comes as [data, encoding], and we only want the first entry
+            in_account_data = True
+        elif prefix == "result.item.account.data.item" and in_account_data:
+            in_account_data = False
+            yield str(based58.b58encode(base64.b64decode(value)[33:65]), "UTF-8")
+        elif prefix == "error.message":
+            raise RuntimeError(f"getProgramAccounts request failed: {value}")
+
+
+class HedgedAsyncClient:
+    """Stand-in for AsyncClient that holds a client per RPC endpoint. Each request goes to the first endpoint, and is
+    hedged by also sending it to the next endpoint if it fails or hasn't come back within hedge_delay seconds. Whichever
+    response comes back successfully first is used, and the rest are cancelled.
+    """
+
+    def __init__(self, endpoints: list, hedge_delay: float = HEDGE_DELAY, timeout: int = 30):
+        self.clients = [async_api.AsyncClient(endpoint, timeout=timeout) for endpoint in endpoints]
+        self.hedge_delay = hedge_delay
+
+    async def __aenter__(self) -> "HedgedAsyncClient":
+        return self
+
+    async def __aexit__(self, _exc_type, _exc, _tb):
+        for client in self.clients:
+            await client.close()
+
+    def __getattr__(self, name: str) -> Callable:
+        # Anything not defined here is an RPC method, so hedge the call across the wrapped clients
+        async def hedged_call(*args, **kwargs):
+            return await self._hedged_request(lambda client: getattr(client, name)(*args, **kwargs))
+
+        return hedged_call
+
+    async def _hedged_request(self, request_fn: Callable) -> RPCResponse:
+        """Make a request against the wrapped clients in order, hedging to the next one when the current one is slow
+        or fails
+
+        :param request_fn: Function that takes a client and returns the request coroutine to run against it
+        :return: The first successful response
+        """
+        pending = set()
+        error = None
+        try:
+            for client in self.clients:
+                pending.add(asyncio.create_task(request_fn(client)))
+                done, pending = await asyncio.wait(
+                    pending, timeout=self.hedge_delay, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+
+            # Every endpoint has a request in flight (or failed), so take whichever succeeds first
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+def create_solana_client() -> HedgedAsyncClient:
     """Make an async Solana client configured for our purposes
 
-    :return: AsyncClient
+    :return: HedgedAsyncClient, which can be used in place of an AsyncClient
     """
-    return async_api.AsyncClient(GPA_RPC_ENDPOINT, timeout=30)
+    return HedgedAsyncClient(ASYNC_RPC_ENDPOINTS)
+
+
+@retry(
+    stop=stop_after_attempt(3),
+    after=after_log(logger, logging.DEBUG),
+    wait=wait_random_exponential(min=1, max=10),
+)
+async def _get_multiple_accounts_chunk(
+    client: async_api.AsyncClient, chunk: list, encoding: str, limiter: AsyncLimiter
+) -> list:
+    """Fetch a single chunk of accounts with one getMultipleAccounts call
+
+    :param client: The Solana client used to make requests
+    :param chunk: The account addresses to fetch (at most MAX_MULTIPLE_ACCOUNTS of them)
+    :param encoding: The encoding to request the account data in
+    :param limiter: An AsyncLimiter used to prevent hitting request limits, and generally be a good citizen.
+    :return: The list of account values, in the same order as the chunk
+    """
+    async with limiter:
+        resp = await client.get_multiple_accounts(chunk, encoding=encoding)
+    return resp["result"]["value"]
+
+
+async def batch_get_account_info(
+    client: async_api.AsyncClient,
+    addresses: list,
+    limiter: AsyncLimiter,
+    encoding: str = "jsonParsed",
+    batch_size: int = MAX_MULTIPLE_ACCOUNTS,
+    on_chunk_done: Optional[Callable[[dict], None]] = None,
+) -> dict:
+    """Fetch account info for many addresses, chunked into concurrent getMultipleAccounts calls
+
+    :param client: The Solana client used to make requests
+    :param addresses: The account addresses to fetch
+    :param limiter: An AsyncLimiter used to prevent hitting request limits, and generally be a good citizen.
+    :param encoding: The encoding to request the account data in
+    :param batch_size: How many addresses to put in each request (the RPC caps this at 100)
+    :param on_chunk_done: Optional function called with the dict of accounts for each chunk as soon as it's fetched,
+        so callers can start working on them before the rest of the chunks are in. If it raises, the chunk is treated
+        as failed
+    :return: dict mapping each address to its account value (None if the account doesn't exist). Addresses whose
+        request failed are omitted
+    """
+
+    async def get_chunk(chunk: list) -> dict:
+        values = await _get_multiple_accounts_chunk(client, chunk, encoding, limiter)
+        chunk_accounts = dict(zip(chunk, values))
+        # Call this from within the task (rather than a done callback) so its errors aren't just logged by the loop
+        if on_chunk_done is not None:
+            on_chunk_done(chunk_accounts)
+        return chunk_accounts
+
+    chunks = [addresses[i : i + batch_size] for i in range(0, len(addresses), batch_size)]
+    tasks = [asyncio.create_task(get_chunk(chunk)) for chunk in chunks]
+    with tqdm(total=len(tasks)) as progress_bar:
+        for task in tasks:
+            task.add_done_callback(lambda _: progress_bar.update())
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+    # Addresses in failed chunks are left out of the result, so callers leave those tokens unpopulated
+    accounts = {}
+    for chunk, chunk_accounts in zip(chunks, results):
+        if isinstance(chunk_accounts, BaseException):
+            logger.warning("Unable to fetch %s accounts: %r", len(chunk), chunk_accounts)
+            continue
+        accounts.update(chunk_accounts)
+    return accounts
 
 
 @retry(
@@ -134,15 +308,20 @@ async def get_token_account_from_solana_async(
     return token
 
 
-def get_holder_account_info_from_solana(all_tokens: dict) -> dict:
+async def get_holder_account_info_from_solana_async(
+    client: async_api.AsyncClient, all_tokens: dict, limiter: AsyncLimiter
+) -> dict:
     """Fetch info about the token account for all tokens in a batched fashion
 
+    :param client: The Solana client used to make requests
     :param all_tokens: A dict of all the token data being operated upon
+    :param limiter: An AsyncLimiter used to prevent hitting request limits, and generally be a good citizen.
     :return: The all_tokens dict populated for each token
     """
     owner_accounts = {}
     for token in all_tokens.values():
-        if token.holder_address is not None:
+        # Skip tokens that are already done, or whose token account lookup failed and still needs retrying
+        if token.holder_address is not None or token.token_account is None:
             continue
         if token.token_account == "":
             token.holder_address = ""
@@ -152,58 +331,104 @@ def get_holder_account_info_from_solana(all_tokens: dict) -> dict:
             owner_accounts[token.token_account] = []
         owner_accounts[token.token_account].append(token.token)
 
-    # Chunk into sets of 100
-    client = api.Client(SOLANA_RPC_ENDPOINT, timeout=30)
-    chunks = list(itertools.zip_longest(*[iter(owner_accounts.keys())] * 100))
-    for chunk in tqdm(chunks, total=len(chunks)):
-        chunk = list(chunk)
-        while chunk and chunk[-1] is None:
-            chunk.pop()
-        result = client.get_multiple_accounts(chunk, encoding="jsonParsed")
-        for i, owner_account in enumerate(chunk):
-            tokens = owner_accounts[owner_account]
-            for token in tokens:
-                if not result["result"]["value"][i]:
+    accounts = await batch_get_account_info(client, list(owner_accounts.keys()), limiter)
+    for owner_account, account in accounts.items():
+        for token in owner_accounts[owner_account]:
+            if not account:
+                all_tokens[token].holder_address = ""
+                all_tokens[token].amount = 0
+            else:
+                token_holders = account["data"]["parsed"]
+
+                # Why is this empty sometimes? Because tokens get nuked, so there is no "holder" to fetch
+                if token_holders.get("info") and token_holders["info"].get("owner"):
+                    all_tokens[token].holder_address = token_holders["info"]["owner"]
+                    all_tokens[token].amount = int(
+                        token_holders["info"].get("tokenAmount").get("amount")
+                    )
+                else:
                     all_tokens[token].holder_address = ""
                     all_tokens[token].amount = 0
-                else:
-                    token_holders = result["result"]["value"][i]["data"]["parsed"]
-
-                    # Why is this empty sometimes? Because tokens get nuked, so there is no "holder" to fetch
-                    if token_holders.get("info") and token_holders["info"].get("owner"):
-                        all_tokens[token].holder_address = token_holders["info"]["owner"]
-                        all_tokens[token].amount = (
-                            token_holders["info"].get("tokenAmount").get("amount")
-                        )
-                    else:
-                        all_tokens[token].holder_address = ""
-                        all_tokens[token].amount = 0
     return all_tokens
 
 
-@retry(
-    stop=stop_after_attempt(3),
-    after=after_log(logger, logging.DEBUG),
-    wait=wait_random_exponential(min=1, max=10),
-)
-async def get_account_info_from_solana_async(
-    client: async_api.AsyncClient, token: Token, limiter: AsyncLimiter
-) -> Token:
-    """Fetch info about a token's metadata account from the Solana network
+def derive_metadata_accounts(mint_keys: list) -> list:
+    """Derive the metadata account address for each of the given mints. This is pure CPU work (the curve checks in
+    PDA derivation take most of a millisecond per mint), so it's kept at module level to run in a worker process.
+
+    :param mint_keys: The token mint addresses to derive metadata accounts for
+    :return: A list of the metadata account addresses, in the same order as mint_keys
+    """
+    return [str(metadata.get_metadata_account(mint_key)) for mint_key in mint_keys]
+
+
+async def derive_metadata_accounts_async(
+    mint_keys: list, chunk_size: int = MAX_MULTIPLE_ACCOUNTS
+) -> list:
+    """Derive metadata account addresses without blocking the event loop, spreading large batches across processes
+
+    :param mint_keys: The token mint addresses to derive metadata accounts for
+    :param chunk_size: How many mints to hand to a worker process at a time
+    :return: A list of the metadata account addresses, in the same order as mint_keys
+    """
+    if len(mint_keys) < PROCESS_POOL_THRESHOLD:
+        return derive_metadata_accounts(mint_keys)
+
+    loop = asyncio.get_running_loop()
+    chunks = [mint_keys[i : i + chunk_size] for i in range(0, len(mint_keys), chunk_size)]
+    with ProcessPoolExecutor() as pool:
+        results = await asyncio.gather(
+            *[loop.run_in_executor(pool, derive_metadata_accounts, chunk) for chunk in chunks]
+        )
+    return list(itertools.chain.from_iterable(results))
+
+
+async def get_metadata_account_info_from_solana_async(
+    client: async_api.AsyncClient,
+    all_tokens: dict,
+    limiter: AsyncLimiter,
+    on_token_done: Optional[Callable[[Token], None]] = None,
+) -> dict:
+    """Fetch info about the metadata accounts for all tokens in a batched fashion
 
     :param client: The Solana client used to make requests
-    :param token: The Token object for which data is being requested
+    :param all_tokens: A dict of all the token data being operated upon
     :param limiter: An AsyncLimiter used to prevent hitting request limits, and generally be a good citizen.
-    :return: The data dict with the "account" key populated with response data
+    :param on_token_done: Optional function called with each token as soon as its metadata account has been fetched
+        (whether or not the account turned out to exist). Not called for tokens whose request failed
+    :return: The all_tokens dict populated for each token
     """
-    async with limiter:
-        metadata_account = metadata.get_metadata_account(token.token)
-        data = await client.get_account_info(metadata_account)
-        decoded_data = base64.b64decode(data["result"]["value"]["data"][0])
-        unpacked_data = metadata.unpack_metadata_account(decoded_data)
-
-        if unpacked_data.get("data") is not None:
-            token.name = unpacked_data["data"].get("name")
-            token.id = token.name[token.name.find("#") + 1 : :]
-            token.data_uri = unpacked_data["data"].get("uri")
-        return token
+    tokens = [token for token in all_tokens.values() if token.name is None]
+    addresses = await derive_metadata_accounts_async([token.token for token in tokens])
+    metadata_accounts = dict(zip(addresses, tokens))
+
+    def unpack_chunk(accounts: dict) -> None:
+        # Unpack the whole chunk before touching any tokens, so a bad account fails the chunk as a unit and leaves all
+        # of its tokens to be fetched again next run
+        unpacked_accounts = {
+            metadata_account: metadata.unpack_metadata_account(base64.b64decode(account["data"][0]))
+            for metadata_account, account in accounts.items()
+            if account
+        }
+        for metadata_account, account in accounts.items():
+            token = metadata_accounts[metadata_account]
+            if not account:
+                logger.warning("No metadata account found for token %s", token.token)
+            elif unpacked_accounts[metadata_account].get("data") is not None:
+                unpacked_data = unpacked_accounts[metadata_account]
+                token.name = unpacked_data["data"].get("name")
+                token.id = token.name[token.name.find("#") + 1 : :]
+                token.data_uri = unpacked_data["data"].get("uri")
+            # The metadata lookup for this token is settled either way, unlike tokens in chunks that failed
+            if on_token_done is not None:
+                on_token_done(token)
+
+    # Unpack each chunk as it lands rather than once everything is in, so on_token_done fires as early as possible
+    await batch_get_account_info(
+        client,
+        list(metadata_accounts.keys()),
+        limiter,
+        encoding="base64",
+        on_chunk_done=unpack_chunk,
+    )
+    return all_tokens
@@ -1,5 +1,7 @@
 import logging
 
+import pandas
+
 logger = logging.getLogger("nft_snapshot.util.token")
 
 
@@ -38,23 +40,22 @@ def get_attribute_counts(trait_map: dict, all_tokens: dict[str, Token]) -> (int,
     :param all_tokens: The preassembled data dict for all tokens
     :return: int: count of tokens with attributes; dict: counts of all values for all attributes
     """
-    tokens_with_attributes_total = 0
-    attribute_counts = {}
-
+    traits = []
     for token in all_tokens.values():
         if token.traits:
-            tokens_with_attributes_total += 1
-            for trait_type in trait_map:
-                value = token.traits[trait_type] if trait_type in token.traits else ""
-                if not attribute_counts.get(trait_type):
-                    attribute_counts[trait_type] = {}
-                if not attribute_counts[trait_type].get(value):
-                    attribute_counts[trait_type][value] = 0
-                attribute_counts[trait_type][value] += 1
+            traits.append(token.traits)
         else:
             logging.info("Token %s has no attributes", token.token)
 
-    return tokens_with_attributes_total, attribute_counts
+    # Count a column per trait rather than walking every token's traits one at a time. Object dtype keeps mixed
+    # str/number trait values as they are, and a trait missing from a token counts as ""
+    trait_table = pandas.DataFrame(traits, columns=list(trait_map), dtype=object).fillna("")
+    attribute_counts = {
+        trait_type: trait_table[trait_type].value_counts(sort=False).to_dict()
+        for trait_type in trait_map
+    }
+
+    return len(traits), attribute_counts
 
 
 def get_attribute_rarities(tokens_with_attributes_total: int, attribute_counts: dict) -> dict: